@@ -1,54 +1,106 @@
 import sqlite3
-from datetime import datetime
+import threading
+import time
 import os
 
 DB_NAME = "zuppa.db"
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+# Callers run these helpers from worker threads (asyncio.to_thread), so each
+# thread gets its own connection; WAL lets readers and the writer work side by side.
+_local = threading.local()
+
+def _conn():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        # Autocommit mode; multi-statement writes BEGIN their own transaction
+        conn = sqlite3.connect(DB_NAME, isolation_level=None, cached_statements=128)
+        conn.row_factory = sqlite3.Row
+        # WAL is persisted in the db file; the rest are per connection.
+        # synchronous=NORMAL skips the fsync per commit, the WAL is synced on checkpoint.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=67108864')
+        _local.conn = conn
     return conn
 
+# Fixed SQL text, so sqlite3's statement cache (keyed on the string) reuses
+# the prepared statement instead of re-parsing it on every call.
+_INSERT = 'INSERT INTO reminders (message, remind_time, event_time, target_user, sent_status) VALUES (?, ?, ?, ?, 0)'
+_SELECT_PENDING = 'SELECT id, remind_time FROM reminders WHERE sent_status = 0 ORDER BY remind_time ASC'
+_SELECT_UNSENT = 'SELECT id, message, event_time, target_user FROM reminders WHERE sent_status = 0 AND id IN ({})'
+_MARK_SENT = 'UPDATE reminders SET sent_status = 1 WHERE id IN ({})'
+_PURGE_SENT = 'DELETE FROM reminders WHERE sent_status = 1 AND remind_time < ?'
+
+# Stay well under SQLite's bound-parameter limit (999 on older builds)
+_MAX_PARAMS = 500
+
+def _chunks(ids):
+    for i in range(0, len(ids), _MAX_PARAMS):
+        chunk = ids[i:i + _MAX_PARAMS]
+        yield ','.join('?' * len(chunk)), chunk
+
 def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message TEXT NOT NULL,
-            remind_time TIMESTAMP NOT NULL,
-            event_time TIMESTAMP,
-            target_user TEXT NOT NULL,
-            sent_status INTEGER DEFAULT 0
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-def add_reminder(message: str, remind_time: datetime, event_time: datetime, target_user: str):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('INSERT INTO reminders (message, remind_time, event_time, target_user, sent_status) VALUES (?, ?, ?, ?, ?)',
-              (message, remind_time, event_time, target_user, 0))
-    conn.commit()
-    reminder_id = c.lastrowid
-    conn.close()
-    return reminder_id
+    conn = _conn()
+    with conn:
+        # Schema, legacy-row migration and index go in as one transaction
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS reminders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message TEXT NOT NULL,
+                remind_time INTEGER NOT NULL,
+                event_time INTEGER NOT NULL,
+                target_user TEXT NOT NULL,
+                sent_status INTEGER DEFAULT 0
+            )
+        ''')
+        # Times are stored as unix seconds (UTC). Older databases stored str(datetime)
+        # text, convert those rows in place; SQLite's strftime understands that format.
+        for column in ('remind_time', 'event_time'):
+            conn.execute(f'''
+                UPDATE reminders SET {column} = CAST(strftime('%s', {column}) AS INTEGER)
+                WHERE typeof({column}) = 'text' AND strftime('%s', {column}) IS NOT NULL
+            ''')
+        # Partial index: only unsent rows are ever looked up by remind_time
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_reminders_pending
+            ON reminders(sent_status, remind_time) WHERE sent_status = 0
+        ''')
+
+def add_reminder(message: str, remind_time: int, event_time: int, target_user: str):
+    # Times are unix seconds (UTC)
+    # Single statement, autocommitted
+    c = _conn().execute(_INSERT, (message, remind_time, event_time, target_user))
+    return c.lastrowid
 
 def get_pending_reminders():
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Get reminders that are due and haven't been sent (status 0)
-    # We'll actually rely on the scheduler to pick them up, or polling.
-    # For now, let's just return all pending for debugging or polling.
-    c.execute('SELECT * FROM reminders WHERE sent_status = 0 ORDER BY remind_time ASC')
-    rows = c.fetchall()
-    conn.close()
+    # Reminders that haven't been sent (status 0), used to re-schedule jobs on startup
+    rows = _conn().execute(_SELECT_PENDING).fetchall()
+    return [dict(row) for row in rows]
+
+def get_unsent_reminders(reminder_ids: list[int]):
+    conn = _conn()
+    rows = []
+    for placeholders, chunk in _chunks(reminder_ids):
+        rows.extend(conn.execute(_SELECT_UNSENT.format(placeholders), chunk).fetchall())
     return [dict(row) for row in rows]
 
-def mark_reminder_sent(reminder_id: int):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('UPDATE reminders SET sent_status = 1 WHERE id = ?', (reminder_id,))
-    conn.commit()
-    conn.close()
+def mark_reminders_sent(reminder_ids: list[int]):
+    if not reminder_ids:
+        return
+    conn = _conn()
+    with conn:
+        # One transaction for all chunks; IMMEDIATE takes the write lock up front
+        conn.execute('BEGIN IMMEDIATE')
+        for placeholders, chunk in _chunks(reminder_ids):
+            conn.execute(_MARK_SENT.format(placeholders), chunk)
+
+def purge_sent(older_than_days: int = 7):
+    # Sent reminders are never read again, drop old ones so the table stays small
+    cutoff = int(time.time()) - older_than_days * 86400
+    conn = _conn()
+    c = conn.execute(_PURGE_SENT, (cutoff,))
+    # Fold the WAL back into the db file and truncate it to give the space back
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    return c.rowcount
@@ -19,6 +19,7 @@ import database
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DISCORD_CHANNEL_ID = os.getenv("DISCORD_CHANNEL_ID")
+CHANNEL_ID = int(DISCORD_CHANNEL_ID) if DISCORD_CHANNEL_ID else None
 
 # Logging setup
 logging.basicConfig(level=logging.INFO)
@@ -32,100 +33,162 @@ intents = discord.Intents.default()
 # intents.messages = True # If we need to listen
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+# Channel reminders are posted to, looked up once the bot is connected
+reminder_channel = None
+
+def get_reminder_channel():
+    """Return the cached reminder channel, looking it up on first use."""
+    global reminder_channel
+    if reminder_channel is None and CHANNEL_ID:
+        reminder_channel = bot.get_channel(CHANNEL_ID)
+    return reminder_channel
+
 # Scheduler Setup
 scheduler = AsyncIOScheduler()
 
-async def check_reminders():
-    """Background task to check DB for due reminders and send them."""
+def schedule_reminder(reminder_id: int, remind_ts: int):
+    """Schedule a one-off job that fires the reminder at its remind time (unix seconds)."""
+    # No misfire grace limit: a job that runs late should still send
+    run_date = datetime.fromtimestamp(remind_ts, timezone.utc)
+    scheduler.add_job(send_reminders, 'date', run_date=run_date, args=[[reminder_id]],
+                      id=f"rem:{reminder_id}", replace_existing=True, misfire_grace_time=None)
+
+def schedule_pending_reminders():
+    """Catch-up on startup: re-schedule every reminder that hasn't been sent yet."""
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    overdue = []
+    for r in database.get_pending_reminders():
+        if not isinstance(r['remind_time'], int):
+            logger.error(f"Skipping reminder {r['id']} with bad remind_time: {r['remind_time']}")
+            continue
+        if r['remind_time'] <= now_ts:
+            overdue.append(r['id'])
+            continue
+        try:
+            schedule_reminder(r['id'], r['remind_time'])
+        except (ValueError, OverflowError, OSError) as e:
+            # One unschedulable row mustn't stop the rest from being caught up
+            logger.error(f"Skipping reminder {r['id']} with bad remind_time: {r['remind_time']} ({e})")
+
+    # Everything missed while we were down goes out right away, as one batch
+    if overdue:
+        logger.info(f"Catching up on {len(overdue)} overdue reminders")
+        scheduler.add_job(send_reminders, args=[overdue], id="rem:overdue",
+                          replace_existing=True, misfire_grace_time=None)
+
+# Undelivered reminders are retried with exponential backoff, capped at an hour
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# How long a job waits for the Discord bot to connect before backing off
+BOT_READY_TIMEOUT = 60
+
+def schedule_retry(job, reminder_ids: list[int], attempt: int):
+    """Re-schedule `job` for these reminders, backing off on each attempt."""
+    delay = min(RETRY_BASE_SECONDS * 2 ** min(attempt, 10), RETRY_MAX_SECONDS)
+    logger.info(f"Retrying {job.__name__} for {len(reminder_ids)} reminders in {delay}s (attempt {attempt + 1})")
+    run_date = datetime.now(timezone.utc) + timedelta(seconds=delay)
+    scheduler.add_job(job, 'date', run_date=run_date, args=[reminder_ids, attempt + 1],
+                      misfire_grace_time=None)
+
+# Bound in-flight Discord sends so a big batch doesn't trip rate limits
+send_slots = asyncio.Semaphore(10)
+
+# Premium Squirrel Inc Formatting
+EMBED_TITLE = "🐿️ Squirrel Inc Reminder!"
+EMBED_COLOR = 0x8B4513 # Saddle Brown
+EMBED_FOOTER = "Powered by Squirrel Inc 🌰"
+# <t:TIMESTAMP:F> = Full Date Time (Wednesday, ... 4:00 PM)
+# <t:TIMESTAMP:R> = Relative (in 30 minutes)
+TIME_DUE_FORMAT = "<t:{0}:F> (<t:{0}:R>)".format
+# Only ever ping the target user, never roles or @everyone
+ALLOWED_MENTIONS = discord.AllowedMentions(users=True, roles=False, everyone=False, replied_user=False)
+
+def build_embed(task: str, event_ts) -> discord.Embed:
+    """Build the reminder embed; event_ts is the event time in unix seconds, if known."""
+    embed = discord.Embed(title=EMBED_TITLE, color=EMBED_COLOR)
+    embed.add_field(name="Task", value=task, inline=False)
+    if isinstance(event_ts, int):
+        embed.add_field(name="Time Due", value=TIME_DUE_FORMAT(event_ts), inline=True)
+    embed.set_footer(text=EMBED_FOOTER)
+    return embed
+
+async def send_one_reminder(channel, r: dict) -> int:
+    """Send a single reminder to Discord, returning its id once delivered."""
+    async with send_slots:
+        logger.info(f"Sending reminder: {r['message']}")
+        embed = build_embed(r['message'], r['event_time'])
+        # Send message with ping content + embed
+        await channel.send(content=f"<@{r['target_user']}>", embed=embed, allowed_mentions=ALLOWED_MENTIONS)
+        return r['id']
+
+async def send_reminders(reminder_ids: list[int], attempt: int = 0):
+    """Scheduled job: send the given reminders to Discord and mark them sent.
+
+    Anything that couldn't be delivered is handed to schedule_retry.
+    """
     try:
-        pending = database.get_pending_reminders()
-        # Ensure we compare against UTC because we store UTC now
-        now = datetime.now(timezone.utc)
-        
-        # Backward compatibility: older records might be naive (no timezone info)
-        # We assume those were server-local. But ideally we migrate.
-        # For this logic, we'll try to treat everything as aware.
-        
-        for r in pending:
-            # Parse stored time
-            if isinstance(r['remind_time'], str):
-                try:
-                    # Attempt robust parsing
-                    try:
-                        remind_time = datetime.strptime(r['remind_time'], '%Y-%m-%d %H:%M:%S.%f%z')
-                    except ValueError:
-                        try:
-                            remind_time = datetime.strptime(r['remind_time'], '%Y-%m-%d %H:%M:%S%z')
-                        except ValueError:
-                            # Fallback for naive strings (old data or simple str())
-                            # Assume they are UTC if we are moving to UTC system
-                            rt_naive = datetime.fromisoformat(str(r['remind_time']).replace('Z', '+00:00'))
-                            if rt_naive.tzinfo is None:
-                                remind_time = rt_naive.replace(tzinfo=timezone.utc)
-                            else:
-                                remind_time = rt_naive
-                except ValueError:
-                     continue # Skip garbage data
-            else:
-                 remind_time = r['remind_time']
-            
-            # If reminder is due
-            # meaningful comparison requires both to be aware
-            if remind_time <= now:
-                logger.info(f"Sending reminder: {r['message']}")
-                try:
-                    if DISCORD_CHANNEL_ID:
-                        channel = bot.get_channel(int(DISCORD_CHANNEL_ID))
-                        if channel:
-                            # Premium Squirrel Inc Formatting
-                            embed = discord.Embed(
-                                title="🐿️ Squirrel Inc Reminder!",
-                                color=0x8B4513 # Saddle Brown
-                            )
-                            embed.add_field(name="Task", value=r['message'], inline=False)
-                            
-                            # Show Event Time if available
-                            if r.get('event_time'):
-                                # Try to parse if string, or use as is
-                                et_display = r['event_time']
-                                timestamp_str = ""
-                                
-                                try:
-                                    if isinstance(et_display, str):
-                                        # Handles '2023-10-27 14:30:00.000000' or similar
-                                        try:
-                                            et_obj = datetime.strptime(et_display, '%Y-%m-%d %H:%M:%S.%f')
-                                        except ValueError:
-                                             et_obj = datetime.strptime(et_display, '%Y-%m-%d %H:%M:%S')
-                                    elif isinstance(et_display, datetime):
-                                        et_obj = et_display
-                                    else:
-                                        et_obj = None
-
-                                    if et_obj:
-                                        ts = int(et_obj.timestamp())
-                                        # <t:TIMESTAMP:F> = Full Date Time (Wednesday, ... 4:00 PM)
-                                        # <t:TIMESTAMP:R> = Relative (in 30 minutes)
-                                        timestamp_str = f"<t:{ts}:F> (<t:{ts}:R>)"
-                                        embed.add_field(name="Time Due", value=timestamp_str, inline=True)
-                                except Exception as e:
-                                    logger.error(f"Error parsing event time for timestamp: {e}")
-                                    # Fallback to string if strictly needed, or just omit
-                                    embed.add_field(name="Time Due (Raw)", value=str(et_display), inline=True)
-
-                            embed.set_footer(text="Powered by Squirrel Inc 🌰")
-                            
-                            # Send message with ping content + embed
-                            await channel.send(content=f"<@{r['target_user']}>", embed=embed)
-                        else:
-                            logger.warning(f"Channel {DISCORD_CHANNEL_ID} not found.")
-                    
-                    database.mark_reminder_sent(r['id'])
-                except Exception as e:
-                    logger.error(f"Failed to send reminder {r['id']}: {e}")
+        # Jobs caught up at startup can fire before the bot has connected;
+        # don't wait forever if it never does (e.g. a bad DISCORD_TOKEN)
+        try:
+            await asyncio.wait_for(bot.wait_until_ready(), timeout=BOT_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Discord bot not ready after {BOT_READY_TIMEOUT}s, can't send {len(reminder_ids)} reminders.")
+            schedule_retry(send_reminders, reminder_ids, attempt)
+            return
+
+        channel = get_reminder_channel()
+        if channel is None:
+            logger.warning(f"Channel {DISCORD_CHANNEL_ID} not found, can't send {len(reminder_ids)} reminders.")
+            schedule_retry(send_reminders, reminder_ids, attempt)
+            return
+
+        # DB calls go to a worker thread so disk I/O doesn't stall the event loop
+        pending = await asyncio.to_thread(database.get_unsent_reminders, reminder_ids)
+    except Exception as e:
+        # Nothing has been sent yet, so the whole batch can be retried
+        logger.error(f"Error in send_reminders: {e}")
+        schedule_retry(send_reminders, reminder_ids, attempt)
+        return
+
+    if not pending:
+        return
+
+    # Fan the sends out concurrently instead of awaiting them one by one
+    tasks = [asyncio.create_task(send_one_reminder(channel, r)) for r in pending]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
 
+    sent_ids = []
+    failed_ids = []
+    for r, result in zip(pending, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Failed to send reminder {r['id']}: {result}")
+            failed_ids.append(r['id'])
+        else:
+            sent_ids.append(result)
+
+    if failed_ids:
+        schedule_retry(send_reminders, failed_ids, attempt)
+    await mark_reminders_sent(sent_ids)
+
+async def mark_reminders_sent(reminder_ids: list[int], attempt: int = 0):
+    """Mark delivered reminders as sent, retrying just this step if the DB write fails.
+
+    Resending instead would deliver the reminders twice.
+    """
+    try:
+        # One UPDATE/transaction for the whole batch
+        await asyncio.to_thread(database.mark_reminders_sent, reminder_ids)
     except Exception as e:
-        logger.error(f"Error in check_reminders: {e}")
+        logger.error(f"Failed to mark reminders {reminder_ids} as sent: {e}")
+        schedule_retry(mark_reminders_sent, reminder_ids, attempt)
+
+async def purge_sent_reminders():
+    """Weekly job: delete old sent reminders and truncate the WAL."""
+    try:
+        purged = await asyncio.to_thread(database.purge_sent)
+        logger.info(f"Purged {purged} sent reminders.")
+    except Exception as e:
+        logger.error(f"Error in purge_sent_reminders: {e}")
 
 # FastAPI Lifestyle
 @asynccontextmanager
@@ -133,13 +196,17 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting Zuppa System...")
     
-    # Start Scheduler
-    scheduler.add_job(check_reminders, 'interval', seconds=30)
-    scheduler.start()
-    
     # Start Discord Bot in background
+    # (before the scheduler, so catch-up jobs can wait on the bot being ready)
     bot_task = asyncio.create_task(bot.start(DISCORD_TOKEN))
     
+    # Start Scheduler, one date job per unsent reminder
+    schedule_pending_reminders()
+    # Weekly cleanup of old sent reminders
+    scheduler.add_job(purge_sent_reminders, 'cron', day_of_week='sun', hour=4,
+                      id="purge_sent", replace_existing=True)
+    scheduler.start()
+    
     yield
     
     # Shutdown
@@ -172,7 +239,10 @@ templates = Jinja2Templates(directory="templates")
 
 @bot.event
 async def on_ready():
+    global reminder_channel
     logger.info(f'Logged in as {bot.user} (ID: {bot.user.id})')
+    # Refresh on every (re)connect, the cached channel object may be stale
+    reminder_channel = bot.get_channel(CHANNEL_ID) if CHANNEL_ID else None
     logger.info('------')
 
 @app.get("/")
@@ -192,30 +262,35 @@ async def create_reminder(
         # 1. Parse the "Wall Clock" time the user typed (e.g. 5:00 PM)
         # It has no timezone info attached yet.
         naive_et = datetime.strptime(event_time, "%Y-%m-%dT%H:%M")
-        
-        # 2. Convert to UTC
-        # client_offset is minutes BEHIND UTC (usually).
-        # Actually JS getTimezoneOffset() returns +min for West (US).
-        # So: Local + Offset = UTC
-        utc_et = naive_et + timedelta(minutes=client_offset)
-        
-        # Make it 'aware' so python knows it's UTC
-        utc_et = utc_et.replace(tzinfo=timezone.utc)
-        
-        # 3. Calculate Remind Time (also UTC)
-        utc_rt = utc_et - timedelta(minutes=offset_minutes)
-        
-        # Store as standard timestamps (or ISO strings)
-        # We will save them as naive UTC strings to keep SQLite simple, or just rely on str()
-        # Ideally, we format explicitly
-        
-        database.add_reminder(message, utc_rt, utc_et, target_user)
-        logger.info(f"Created reminder for {target_user}. Event(UTC): {utc_et}")
     except ValueError as e:
         logger.error(f"Date parsing error: {e}")
+        return RedirectResponse(url="/", status_code=303)
+    
+    # 2. Convert to UTC unix seconds
+    # client_offset is minutes BEHIND UTC (usually).
+    # Actually JS getTimezoneOffset() returns +min for West (US).
+    # So: Local + Offset = UTC
+    event_ts = int(naive_et.replace(tzinfo=timezone.utc).timestamp()) + client_offset * 60
+    
+    # 3. Calculate Remind Time (also UTC)
+    remind_ts = event_ts - offset_minutes * 60
+    
+    # Both times must be representable as datetimes (the scheduler needs one),
+    # check before storing anything so a bad offset can't leave a poison row
+    try:
+        utc_et = datetime.fromtimestamp(event_ts, timezone.utc)
+        datetime.fromtimestamp(remind_ts, timezone.utc)
+    except (ValueError, OverflowError, OSError) as e:
+        logger.error(f"Reminder time out of range (offset_minutes={offset_minutes}, client_offset={client_offset}): {e}")
+        return RedirectResponse(url="/", status_code=303)
+    
+    reminder_id = await asyncio.to_thread(database.add_reminder, message, remind_ts, event_ts, target_user)
+    schedule_reminder(reminder_id, remind_ts)
+    logger.info(f"Created reminder for {target_user}. Event(UTC): {utc_et}")
     
     return RedirectResponse(url="/", status_code=303)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # "auto" runs on uvloop when it's installed (it isn't available on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto")